@@ -1,37 +1,63 @@
 # plot_results.py
 import os, sqlite3, math, time, json
 from pathlib import Path
+import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 import seaborn as sns
 import requests
+from requests.adapters import HTTPAdapter
 
 BASE = os.environ.get("SBOS_BASE", "http://localhost:8083")
 DB_PATH = "sbos.db"
+CHUNK_ROWS = 100_000
 OUT = Path("plots")
 OUT.mkdir(exist_ok=True)
 
+# shared keep-alive session so repeated health polls reuse one connection
+_S = requests.Session()
+_S.mount(BASE, HTTPAdapter(pool_maxsize=2))
+
 sns.set_theme(style="whitegrid")
 
-def load_timeseries():
+def read_sql_chunked(sql, columns, categorical=()):
+    # ts comes back as datetime; ORDER BY ts walks the ts index the server creates.
+    # Label columns become category per chunk, so only integer codes are kept
+    # between chunks instead of full object-dtype string columns.
     con = sqlite3.connect(DB_PATH)
+    chunks = []
     try:
-        df = pd.read_sql("SELECT ts, point_label, value FROM timeseries ORDER BY ts ASC", con)
-        return df
+        for chunk in pd.read_sql(sql, con, chunksize=CHUNK_ROWS, parse_dates={"ts": {"unit": "s"}}):
+            for col in categorical:
+                chunk[col] = chunk[col].astype("category")
+            chunks.append(chunk)
     finally:
         con.close()
+    if not chunks:
+        df = pd.DataFrame(columns=columns)
+        for col in categorical:
+            df[col] = df[col].astype("category")
+        return df
+    # concat only keeps category dtype when every chunk has the same categories
+    for col in categorical:
+        cats = sorted(set().union(*(c[col].cat.categories for c in chunks)))
+        for c in chunks:
+            c[col] = c[col].cat.set_categories(cats)
+    return pd.concat(chunks, ignore_index=True)
+
+def load_timeseries():
+    cols = ["ts", "point_label", "value"]
+    return read_sql_chunked(f"SELECT {', '.join(cols)} FROM timeseries ORDER BY ts ASC", cols,
+                            categorical=["point_label"])
 
 def load_txlog():
-    con = sqlite3.connect(DB_PATH)
-    try:
-        df = pd.read_sql("SELECT ts, actor, app_id, user_id, action, point_label, value, decision, reason FROM txlog ORDER BY ts ASC", con)
-        return df
-    finally:
-        con.close()
+    cols = ["ts", "actor", "app_id", "user_id", "action", "point_label", "value", "decision", "reason"]
+    return read_sql_chunked(f"SELECT {', '.join(cols)} FROM txlog ORDER BY ts ASC", cols,
+                            categorical=["actor", "action", "point_label", "decision", "reason"])
 
 def get_health():
     try:
-        r = requests.get(f"{BASE}/health", timeout=5)
+        r = _S.get(f"{BASE}/health", timeout=(1, 4))
         return r.json()
     except Exception:
         return {"status":"unreachable"}
@@ -41,12 +67,17 @@ def plot_timeseries(df_ts):
         print("No timeseries data to plot.")
         return
     
-    df = df_ts.copy()
-    df["t"] = pd.to_datetime(df["ts"], unit="s")
-    
+    # sort once by (label, ts) and plot contiguous slices instead of dispatching a groupby
+    df = df_ts.sort_values(["point_label", "ts"])
+    codes = df["point_label"].cat.codes.to_numpy()
+    labels = df["point_label"].cat.categories
+    t = df["ts"].to_numpy()
+    v = df["value"].to_numpy()
+    bounds = np.r_[0, np.flatnonzero(codes[1:] != codes[:-1]) + 1, len(codes)]
+
     plt.figure(figsize=(10,6))
-    for label, dfg in df.groupby("point_label"):
-        plt.plot(dfg["t"], dfg["value"], label=label)
+    for s, e in zip(bounds[:-1], bounds[1:]):
+        plt.plot(t[s:e], v[s:e], label=labels[codes[s]])
     plt.title("Setpoint Time Series")
     plt.xlabel("Time")
     plt.ylabel("Value")
@@ -60,9 +91,11 @@ def plot_enforcement_bars(df_tx):
         print("No txlog data to plot.")
         return
     
-    dec_counts = df_tx.groupby("decision").size().reset_index(name="count")
+    # one actor x decision table serves both the overall bars and the regulator-deny check
+    ct = pd.crosstab(df_tx["actor"], df_tx["decision"])
+    dec_counts = ct.sum(axis=0).rename_axis("decision").reset_index(name="count")
     plt.figure(figsize=(6,4))
-    sns.barplot(data=dec_counts, x="decision", y="count", color="#69b3a2")
+    sns.barplot(data=dec_counts, x="decision", y="count", order=dec_counts["decision"], color="#69b3a2")
     plt.title("Write Decisions (All Actors)")
     plt.xlabel("Decision")
     plt.ylabel("Count")
@@ -71,11 +104,11 @@ def plot_enforcement_bars(df_tx):
     plt.close()
 
     
-    denies = df_tx[(df_tx["decision"]=="deny") & (df_tx["actor"]=="regulator")]
-    if not denies.empty:
-        rs = denies.groupby("reason").size().reset_index(name="count").sort_values("count", ascending=False)
+    if "deny" in ct and ct["deny"].get("regulator", 0) > 0:
+        reasons = df_tx.loc[(df_tx["actor"]=="regulator") & (df_tx["decision"]=="deny"), "reason"].value_counts()
+        rs = reasons[reasons > 0].rename_axis("reason").reset_index(name="count")
         plt.figure(figsize=(10,5))
-        sns.barplot(data=rs, x="reason", y="count", color="#d95f02")
+        sns.barplot(data=rs, x="reason", y="count", order=rs["reason"], color="#d95f02")
         plt.title("Denied Writes by Reason (Regulator)")
         plt.xlabel("Reason")
         plt.ylabel("Count")
@@ -87,18 +120,17 @@ def plot_enforcement_bars(df_tx):
 def plot_requests_per_minute(df_tx):
     if df_tx.empty:
         return
-    df = df_tx.copy()
-    df["t"] = pd.to_datetime(df["ts"], unit="s")
-    df["minute"] = df["t"].dt.floor("T")
-    writes = df[df["action"]=="write"].groupby("minute").size().reset_index(name="writes")
-    allow = df[(df["action"]=="write") & (df["decision"]=="allow")].groupby("minute").size().reset_index(name="allow")
-    deny = df[(df["action"]=="write") & (df["decision"]=="deny")].groupby("minute").size().reset_index(name="deny")
-    agg = writes.merge(allow, on="minute", how="left").merge(deny, on="minute", how="left").fillna(0)
+    df = df_tx[df_tx["action"]=="write"]
+    if df.empty:
+        return
+    counts = df.groupby([df["ts"].dt.floor("min").rename("minute"), "decision"], observed=True).size().unstack(fill_value=0)
+    agg = counts.reindex(columns=["allow", "deny"], fill_value=0)
+    agg["writes"] = counts.sum(axis=1)
 
     plt.figure(figsize=(10,5))
-    plt.plot(agg["minute"], agg["writes"], label="Write attempts", lw=2)
-    plt.plot(agg["minute"], agg["allow"], label="Allowed", lw=2)
-    plt.plot(agg["minute"], agg["deny"], label="Denied", lw=2)
+    plt.plot(agg.index, agg["writes"], label="Write attempts", lw=2)
+    plt.plot(agg.index, agg["allow"], label="Allowed", lw=2)
+    plt.plot(agg.index, agg["deny"], label="Denied", lw=2)
     plt.title("Writes per Minute (Attempts vs Allowed/Denied)")
     plt.xlabel("Minute")
     plt.ylabel("Count")
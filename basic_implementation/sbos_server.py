@@ -36,6 +36,8 @@ DB.execute("""CREATE TABLE IF NOT EXISTS timeseries(
   id INTEGER PRIMARY KEY AUTOINCREMENT,
   ts REAL, point_label TEXT, value REAL
 );""")
+DB.execute("CREATE INDEX IF NOT EXISTS idx_timeseries_ts ON timeseries(ts)")
+DB.execute("CREATE INDEX IF NOT EXISTS idx_txlog_ts ON txlog(ts)")
 DB.commit()
 
 # ---------------- Global state, caches, and update lock ----------------
@@ -1,16 +1,22 @@
 import os, time, requests, random
+from requests.adapters import HTTPAdapter
 
 BASE = os.environ.get("SBOS_BASE", "http://localhost:8083")
 API_KEY = os.environ["SBOS_APP_KEY"]  # injected by App Steward
 
+# one keep-alive connection for get_caps + all writes
+SESSION = requests.Session()
+SESSION.headers.update({"X-App-Key": API_KEY})
+SESSION.mount(BASE, HTTPAdapter(pool_connections=1, pool_maxsize=4))
+
 def get_caps():
-    r = requests.get(f"{BASE}/capabilities", headers={"X-App-Key": API_KEY}, timeout=5)
+    r = SESSION.get(f"{BASE}/capabilities", timeout=5)
     r.raise_for_status()
     return r.json()["points"]
 
 def write_point(label, value, prev=None):
     body = {"point_label": label, "value": value, "prev_value": prev}
-    r = requests.post(f"{BASE}/write", json=body, headers={"X-App-Key": API_KEY}, timeout=5)
+    r = SESSION.post(f"{BASE}/write", json=body, timeout=5)
     return r.status_code, r.text
 
 def main():
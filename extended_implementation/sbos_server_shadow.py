@@ -1,7 +1,11 @@
 # sbos_server_shadow.py
-import os, time, json, yaml, sqlite3, threading, subprocess, signal
-from typing import Dict, List, Optional, Tuple
-from fastapi import FastAPI, HTTPException, Header
+import os, re, sys, time, json, yaml, sqlite3, threading, subprocess, signal, queue, logging
+from contextlib import asynccontextmanager, contextmanager
+from dataclasses import dataclass
+from types import MappingProxyType
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+from fastapi import Depends, FastAPI, HTTPException, Header
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from brickschema.graph import Graph
 from jinja2 import Template
@@ -12,12 +16,22 @@ PROFILES_FILE = "permission_profiles.yaml"
 USERS_FILE = "users.yaml"
 DB_FILE = "sbos.db"
 
-app = FastAPI(title="Playground-like SBOS + Shadow Guards")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    stop_log_writer()  # flush queued audit rows before the process exits
+
+app = FastAPI(title="Playground-like SBOS + Shadow Guards", lifespan=lifespan)
+logger = logging.getLogger("sbos")
 
 # ---------------- Persistence ----------------
 def db():
     conn = sqlite3.connect(DB_FILE, check_same_thread=False)
     conn.execute("PRAGMA journal_mode=WAL;")
+    conn.execute("PRAGMA synchronous=NORMAL;")
+    conn.execute("PRAGMA temp_store=MEMORY;")
+    conn.execute("PRAGMA mmap_size=268435456;")
+    conn.execute("PRAGMA wal_autocheckpoint=10000;")
     return conn
 
 DB = db()
@@ -39,13 +53,50 @@ DB.execute("""CREATE TABLE IF NOT EXISTS timeseries(
   id INTEGER PRIMARY KEY AUTOINCREMENT,
   ts REAL, point_label TEXT, value REAL
 );""")
+DB.execute("CREATE INDEX IF NOT EXISTS idx_timeseries_ts ON timeseries(ts)")
+DB.execute("CREATE INDEX IF NOT EXISTS idx_txlog_ts ON txlog(ts)")
 DB.execute("""CREATE TABLE IF NOT EXISTS shadowlog(
   id INTEGER PRIMARY KEY AUTOINCREMENT,
   ts REAL, app_id TEXT, user_id TEXT, point_iri TEXT, point_label TEXT,
   value REAL, cls TEXT, vtype TEXT, reason TEXT
 );""")
+DB.execute("CREATE INDEX IF NOT EXISTS idx_shadow_lvr ON shadowlog(point_label, vtype, reason)")
+DB.execute("CREATE INDEX IF NOT EXISTS idx_txlog_actor_dec ON txlog(actor, decision)")
 DB.commit()
 
+# Read-only connections for the /admin/* log queries. Under WAL they read
+# concurrently with the log writer thread instead of queueing behind DB.
+READ_POOL_SIZE = 4
+READ_POOL_TIMEOUT = 5.0  # seconds to wait for a free connection before 503
+
+def open_read_pool(size: int) -> "queue.Queue[sqlite3.Connection]":
+    pool: "queue.Queue[sqlite3.Connection]" = queue.Queue()
+    for _ in range(size):
+        conn = sqlite3.connect(DB_FILE, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA query_only=1;")
+        conn.row_factory = sqlite3.Row
+        pool.put(conn)
+    return pool
+
+_READ_POOL = open_read_pool(READ_POOL_SIZE)
+
+def acquire_read_conn() -> sqlite3.Connection:
+    try:
+        return _READ_POOL.get(timeout=READ_POOL_TIMEOUT)
+    except queue.Empty:
+        raise HTTPException(503, "Read pool busy, retry later")
+
+def release_read_conn(conn: sqlite3.Connection):
+    _READ_POOL.put(conn)
+
+@contextmanager
+def read_conn():
+    conn = acquire_read_conn()
+    try:
+        yield conn
+    finally:
+        release_read_conn(conn)
+
 # ---------------- Global state, caches, update lock ----------------
 G = Graph()
 PROFILES = {}
@@ -53,26 +104,86 @@ POLICY = {}
 USERS = {}
 IRI2LABEL: Dict[str,str] = {}
 LABEL2IRI: Dict[str,str] = {}
+IRI2CLASS: Dict[str,str] = {}
+IRI2LOCALCLASS: Dict[str,str] = {}
+LABEL_IS_COOL_SP: Dict[str,bool] = {}
+TYPED_LABELS: Dict[str,Set[str]] = {}   # class iri -> labels of entities of that class
 UPDATE_LOCK = threading.RLock()
 
+# validator caches used by /write; rebuilt by load_all() and admin_promote_shadow()
+Validator = Callable[[str, str, float, Optional[float]], Tuple[bool,str]]
+ClassValidator = Callable[[str, float, Optional[float]], Tuple[bool,str]]
+_CLASS_VALIDATOR: Dict[str,ClassValidator] = {}                    # local class -> generated enforced chain
+_SHADOW_VALIDATORS_CACHE: Dict[str,Tuple[Validator,...]] = {}      # local class -> callables
+_SHADOW_VALIDATORS_META: Dict[str,Tuple[str,...]] = {}             # local class -> vtypes
+_CONSTRAINTS: Dict[str,Any] = {}   # policy constraints; the constraints table is only an audit copy
+
+@dataclass(frozen=True)
+class GuardParams:
+    min: Optional[float]
+    max: Optional[float]
+    max_step: Optional[float]
+    energy_budget_watts: float
+    energy_per_degree: float
+    min_cool_setpoint: float
+    comfort_min: float
+    comfort_max: float
+
+_GUARDS: Dict[str,GuardParams] = {}   # local class -> guard bounds + constraints
+_DEFAULT_GUARD: Optional[GuardParams] = None
+
+def _load_vtypes(table: str) -> Dict[str,Tuple[str,...]]:
+    names: Dict[str,List[str]] = {}
+    for cls, vtype in DB.execute(f"SELECT resource_class, vtype FROM {table} ORDER BY position ASC"):
+        names.setdefault(cls, []).append(vtype)
+    return {cls: tuple(vtypes) for cls, vtypes in names.items()}
+
+def refresh_db_caches():
+    # build everything first so a bad policy leaves the previous caches in place
+    with UPDATE_LOCK:
+        enforced = _load_vtypes("validators")
+        shadow = _load_vtypes("shadow_validators")
+        for table, chains in (("validators", enforced), ("shadow_validators", shadow)):
+            for local, vtypes in chains.items():
+                for v in vtypes:
+                    if v not in VALIDATOR_FUNS:
+                        raise ValueError(f"Unknown validator type '{v}' for {local} in {table}")
+        class_validator = {local: compile_class_validator(local, vtypes) for local, vtypes in enforced.items()}
+        shadow_funs = {local: tuple(VALIDATOR_FUNS[v] for v in vtypes) for local, vtypes in shadow.items()}
+        _CLASS_VALIDATOR.clear(); _CLASS_VALIDATOR.update(class_validator)
+        _SHADOW_VALIDATORS_CACHE.clear(); _SHADOW_VALIDATORS_CACHE.update(shadow_funs)
+        _SHADOW_VALIDATORS_META.clear(); _SHADOW_VALIDATORS_META.update(shadow)
+
 def load_all():
-    global G, PROFILES, POLICY, USERS, IRI2LABEL, LABEL2IRI
+    global G, PROFILES, POLICY, USERS, IRI2LABEL, LABEL2IRI, _DEFAULT_GUARD
     with UPDATE_LOCK:
         G = Graph()
         G.load_file(MODEL_FILE)
         PROFILES = yaml.safe_load(open(PROFILES_FILE))
         POLICY = yaml.safe_load(open(POLICY_FILE))
         USERS = yaml.safe_load(open(USERS_FILE))
-        IRI2LABEL.clear(); LABEL2IRI.clear()
+        _CONSTRAINTS.clear(); _CONSTRAINTS.update(POLICY.get("constraints", {}))
+        IRI2LABEL.clear(); LABEL2IRI.clear(); IRI2CLASS.clear(); IRI2LOCALCLASS.clear(); LABEL_IS_COOL_SP.clear()
+        TYPED_LABELS.clear()
         rows = G.query("""
           PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
-          SELECT ?pt ?lbl WHERE { ?pt rdfs:label ?lbl . }
+          SELECT ?pt ?lbl ?cls WHERE { ?pt rdfs:label ?lbl . OPTIONAL { ?pt a ?cls . } }
         """)
         for r in rows:
-            IRI2LABEL[str(r["pt"])] = str(r["lbl"])
-            LABEL2IRI[str(r["lbl"])] = str(r["pt"])
+            pt = sys.intern(str(r["pt"]))
+            lbl = sys.intern(str(r["lbl"]))
+            IRI2LABEL[pt] = lbl
+            LABEL2IRI[lbl] = pt
+            LABEL_IS_COOL_SP[lbl] = "Cool_SP" in lbl
+            if r["cls"] is None:
+                continue
+            cls = str(r["cls"])
+            TYPED_LABELS.setdefault(cls, set()).add(lbl)
+            if pt not in IRI2CLASS:
+                IRI2CLASS[pt] = cls
+                IRI2LOCALCLASS[pt] = sys.intern(cls.rsplit("#", 1)[-1])
         with DB:
-            for k,v in POLICY.get("constraints", {}).items():
+            for k,v in _CONSTRAINTS.items():
                 DB.execute("INSERT OR REPLACE INTO constraints(key,value) VALUES(?,?)", (k, json.dumps(v)))
             DB.execute("DELETE FROM validators")
             for cls, arr in POLICY.get("validators", {}).get("defaults", {}).items():
@@ -82,8 +193,24 @@ def load_all():
             for cls, arr in POLICY.get("shadow_validators", {}).get("defaults", {}).items():
                 for pos, spec in enumerate(arr):
                     DB.execute("INSERT INTO shadow_validators(resource_class,position,vtype) VALUES(?,?,?)", (cls, pos, spec["type"]))
-
-load_all()
+        c = _CONSTRAINTS
+        shared = dict(
+            energy_budget_watts=c.get("energy_budget_watts", 5000),
+            energy_per_degree=c.get("energy_per_degree_watts", 150),
+            min_cool_setpoint=c.get("min_cool_setpoint", 20.0),
+            comfort_min=c.get("comfort_min", 21.0),
+            comfort_max=c.get("comfort_max", 24.0),
+        )
+        guards = POLICY.get("guards") or {}
+        _GUARDS.clear()
+        classes = set(guards)
+        classes.update(POLICY.get("validators", {}).get("defaults", {}))
+        classes.update(POLICY.get("shadow_validators", {}).get("defaults", {}))
+        for local in classes:
+            g = guards.get(local) or {}
+            _GUARDS[local] = GuardParams(min=g.get("min"), max=g.get("max"), max_step=g.get("max_step"), **shared)
+        _DEFAULT_GUARD = GuardParams(min=None, max=None, max_step=None, **shared)
+        refresh_db_caches()
 
 # ---------------- Brick helpers ----------------
 def query_iris(sparql: str) -> List[str]:
@@ -91,22 +218,26 @@ def query_iris(sparql: str) -> List[str]:
     return [str(r["pt"]) for r in rows]
 
 def class_of_iri(iri: str) -> Optional[str]:
-    rows = G.query(f"SELECT ?cls WHERE {{ <{iri}> a ?cls . }}")
-    for r in rows:
-        return str(r["cls"])
-    return None
+    return IRI2CLASS.get(iri)
+
+PREFIXES = {
+    "rdfs": "http://www.w3.org/2000/01/rdf-schema#",
+    "brick": "https://brickschema.org/schema/Brick#",
+}
+
+def expand_qname(qname: str) -> str:
+    if qname.startswith("<") and qname.endswith(">"):
+        return qname[1:-1]
+    prefix, sep, local = qname.partition(":")
+    if sep and prefix in PREFIXES:
+        return PREFIXES[prefix] + local
+    return qname
 
 def require_typed_label(label: str, brick_type_qname: str):
-    rows = G.query(f"""
-      PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
-      PREFIX brick: <https://brickschema.org/schema/Brick#>
-      SELECT ?x WHERE {{ ?x a {brick_type_qname} ; rdfs:label "{label}" . }}
-    """)
-    if not any(True for _ in rows):
+    if label not in TYPED_LABELS.get(expand_qname(brick_type_qname), ()):
         raise HTTPException(400, f"Typed argument check failed: label '{label}' is not a {brick_type_qname}")
 
 # ---------------- Permission Manager ----------------
-from dataclasses import dataclass
 @dataclass
 class Manifest:
     app_id: str
@@ -144,8 +275,17 @@ def compute_caps(man: Manifest) -> Dict[str,List[str]]:
         "write": [i for i in app_write if i in uwrite],
     }
 
-APPS: Dict[str, Dict] = {}    # app_instance_id -> {manifest,pid,key,caps,user,rate}
-APP_KEYS: Dict[str, str] = {}  # api_key -> app_instance_id
+_APPS: Dict[str, Dict] = {}    # app_instance_id -> {manifest,pid,key,caps,user,rate}
+_APP_KEYS: Dict[str, str] = {}  # api_key -> app_instance_id
+APPS_LOCK = threading.Lock()    # guards _APPS/_APP_KEYS mutation and reader snapshots; never held across I/O
+# read-only views for everything outside start/stop_app_instance
+APPS = MappingProxyType(_APPS)
+APP_KEYS = MappingProxyType(_APP_KEYS)
+
+def apps_snapshot() -> List[Tuple[str, Dict]]:
+    # iterate this, not APPS.items(): start/stop_app_instance run on other threads
+    with APPS_LOCK:
+        return list(_APPS.items())
 
 # ---------------- Resource Proxy + logs ----------------
 STATE: Dict[str,float] = {
@@ -155,19 +295,95 @@ STATE: Dict[str,float] = {
     "F2_ZoneB_Heat_SP": 21.0,
 }
 
+# log rows are queued and written by one background thread in batched transactions
+LOG_Q: "queue.Queue[Optional[Tuple[str, tuple]]]" = queue.Queue()   # (insert sql, row); None stops the writer
+LOG_BATCH_MAX = 500
+LOG_FLUSH_SECONDS = 0.05
+LOG_RETRIES = 5          # attempts per batch on OperationalError (e.g. SQLITE_BUSY)
+LOG_RETRY_SECONDS = 0.2
+TXLOG_SQL = "INSERT INTO txlog(ts,actor,app_id,user_id,action,point_iri,point_label,value,decision,reason) VALUES(?,?,?,?,?,?,?,?,?,?)"
+TIMESERIES_SQL = "INSERT INTO timeseries(ts,point_label,value) VALUES(?,?,?)"
+SHADOWLOG_SQL = "INSERT INTO shadowlog(ts,app_id,user_id,point_iri,point_label,value,cls,vtype,reason) VALUES(?,?,?,?,?,?,?,?,?)"
+
 def log_tx(actor, app_id, user_id, action, iri, label, value, decision, reason):
-    with DB:
-        DB.execute("INSERT INTO txlog(ts,actor,app_id,user_id,action,point_iri,point_label,value,decision,reason) VALUES(?,?,?,?,?,?,?,?,?,?)",
-                   (time.time(), actor, app_id, user_id, action, iri, label, value, decision, reason))
+    LOG_Q.put((TXLOG_SQL, (time.time(), actor, app_id, user_id, action, iri, label, value, decision, reason)))
 
 def log_timeseries(label: str, value: float):
-    with DB:
-        DB.execute("INSERT INTO timeseries(ts,point_label,value) VALUES(?,?,?)", (time.time(), label, value))
+    LOG_Q.put((TIMESERIES_SQL, (time.time(), label, value)))
 
 def log_shadow(app_id, user_id, iri, label, value, cls, vtype, reason):
-    with DB:
-        DB.execute("INSERT INTO shadowlog(ts,app_id,user_id,point_iri,point_label,value,cls,vtype,reason) VALUES(?,?,?,?,?,?,?,?,?)",
-                   (time.time(), app_id, user_id, iri, label, value, cls, vtype, reason))
+    LOG_Q.put((SHADOWLOG_SQL, (time.time(), app_id, user_id, iri, label, value, cls, vtype, reason)))
+
+def next_log_batch() -> Tuple[List[Tuple[str, tuple]], bool]:
+    # returns (rows, stop); stop is set once the None sentinel is dequeued
+    item = LOG_Q.get()
+    if item is None:
+        return [], True
+    batch = [item]
+    deadline = time.time() + LOG_FLUSH_SECONDS
+    while len(batch) < LOG_BATCH_MAX:
+        left = deadline - time.time()
+        if left <= 0:
+            break
+        try:
+            item = LOG_Q.get(timeout=left)
+        except queue.Empty:
+            break
+        if item is None:
+            return batch, True
+        batch.append(item)
+    return batch, False
+
+def write_log_batch(conn: sqlite3.Connection, cur: sqlite3.Cursor, batch: List[Tuple[str, tuple]]):
+    rows: Dict[str, List[tuple]] = {}
+    for sql, row in batch:
+        rows.setdefault(sql, []).append(row)
+    for attempt in range(1, LOG_RETRIES + 1):
+        try:
+            cur.execute("BEGIN IMMEDIATE")
+            for sql, rs in rows.items():
+                cur.executemany(sql, rs)
+            cur.execute("COMMIT")
+            return
+        except sqlite3.OperationalError as e:
+            if conn.in_transaction:
+                cur.execute("ROLLBACK")
+            if attempt == LOG_RETRIES:
+                raise
+            logger.warning("log writer: batch of %d rows failed (%s), retry %d/%d", len(batch), e, attempt, LOG_RETRIES - 1)
+            time.sleep(LOG_RETRY_SECONDS * attempt)
+
+def log_writer_loop():
+    # one long-lived connection and cursor; the connection's statement cache
+    # keeps the three INSERTs prepared across batches
+    conn = db()
+    conn.isolation_level = None  # explicit BEGIN/COMMIT below
+    cur = conn.cursor()
+    stop = False
+    while not stop:
+        batch: List[Tuple[str, tuple]] = []
+        try:
+            batch, stop = next_log_batch()
+            if batch:
+                write_log_batch(conn, cur, batch)
+        except Exception:
+            # never let the thread die: LOG_Q would then grow without a consumer
+            logger.exception("log writer: dropped %d rows", len(batch))
+            try:
+                if conn.in_transaction:
+                    cur.execute("ROLLBACK")
+            except sqlite3.Error:
+                logger.exception("log writer: rollback failed")
+    conn.close()
+
+def stop_log_writer(timeout: float = 10.0):
+    # rows queued before the sentinel are written before the thread exits
+    if LOG_T.is_alive():
+        LOG_Q.put(None)
+        LOG_T.join(timeout)
+
+LOG_T = threading.Thread(target=log_writer_loop, daemon=True)
+LOG_T.start()
 
 def proxy_read(label: str) -> Optional[float]:
     return STATE.get(label, None)
@@ -175,57 +391,45 @@ def proxy_read(label: str) -> Optional[float]:
 def proxy_write(label: str, value: float):
     STATE[label] = value
     log_timeseries(label, value)
+    if LABEL_IS_COOL_SP.get(label, False):
+        track_low(label, value < POLICY.get("monitor", {}).get("cooling_min", 20.0))
 
 # ---------------- Validators (enforced + shadow) ----------------
-def get_constraints() -> Dict[str, any]:
-    cur = DB.execute("SELECT key,value FROM constraints")
-    return {k: json.loads(v) for (k,v) in cur.fetchall()}
-
-def get_validators_for_class(cls: str) -> List[str]:
-    local = cls.split("#")[-1] if "#" in cls else cls
-    cur = DB.execute("SELECT vtype FROM validators WHERE resource_class=? ORDER BY position ASC", (local,))
-    return [r[0] for r in cur.fetchall()]
-
-def get_shadow_validators_for_class(cls: str) -> List[str]:
-    local = cls.split("#")[-1] if "#" in cls else cls
-    cur = DB.execute("SELECT vtype FROM shadow_validators WHERE resource_class=? ORDER BY position ASC", (local,))
-    return [r[0] for r in cur.fetchall()]
-
-def v_range(cls: str, label: str, value: float, prev: Optional[float]) -> Tuple[bool,str]:
-    local = cls.split("#")[-1] if "#" in cls else cls
-    g = POLICY["guards"].get(local, None)
-    if not g:
+def get_shadow_validators_for_class(local: str) -> Tuple[Tuple[Validator,...], Tuple[str,...]]:
+    return _SHADOW_VALIDATORS_CACHE.get(local, ()), _SHADOW_VALIDATORS_META.get(local, ())
+
+def guard_for(local: str) -> GuardParams:
+    return _GUARDS.get(local) or _DEFAULT_GUARD
+
+def v_range(local: str, label: str, value: float, prev: Optional[float]) -> Tuple[bool,str]:
+    gp = guard_for(local)
+    if gp.min is None or gp.max is None:
         return True, "no-range"
-    if value < g["min"] or value > g["max"]:
-        return False, f"range {g['min']}–{g['max']}"
+    if value < gp.min or value > gp.max:
+        return False, f"range {gp.min}–{gp.max}"
     return True, "ok"
 
-def v_rate(cls: str, label: str, value: float, prev: Optional[float]) -> Tuple[bool,str]:
-    local = cls.split("#")[-1] if "#" in cls else cls
-    g = POLICY["guards"].get(local, None)
-    if not g or prev is None:
+def v_rate(local: str, label: str, value: float, prev: Optional[float]) -> Tuple[bool,str]:
+    gp = guard_for(local)
+    if gp.max_step is None or prev is None:
         return True, "no-rate"
-    if abs(value - prev) > g["max_step"]:
-        return False, f"step>{g['max_step']}"
+    if abs(value - prev) > gp.max_step:
+        return False, f"step>{gp.max_step}"
     return True, "ok"
 
-def v_energy_budget(cls: str, label: str, value: float, prev: Optional[float]) -> Tuple[bool,str]:
-    c = get_constraints()
-    watts = c.get("energy_budget_watts", 5000)
-    per_deg = c.get("energy_per_degree_watts", 150)
-    if "Cool_SP" in label and value < c.get("min_cool_setpoint", 20.0):
-        need = int((20.0 - value) * per_deg)
-        if need > watts:
+def v_energy_budget(local: str, label: str, value: float, prev: Optional[float]) -> Tuple[bool,str]:
+    gp = guard_for(local)
+    if LABEL_IS_COOL_SP.get(label, False) and value < gp.min_cool_setpoint:
+        need = int((20.0 - value) * gp.energy_per_degree)
+        if need > gp.energy_budget_watts:
             return False, "energy_budget"
     return True, "ok"
 
 # comfort band (21–24 C) to evaluate stricter policy without enforcement
-def v_comfort_band(cls: str, label: str, value: float, prev: Optional[float]) -> Tuple[bool,str]:
-    c = get_constraints()
-    lo = c.get("comfort_min", 21.0)
-    hi = c.get("comfort_max", 24.0)
-    if value < lo or value > hi:
-        return False, f"comfort_band {lo}–{hi}"
+def v_comfort_band(local: str, label: str, value: float, prev: Optional[float]) -> Tuple[bool,str]:
+    gp = guard_for(local)
+    if value < gp.comfort_min or value > gp.comfort_max:
+        return False, f"comfort_band {gp.comfort_min}–{gp.comfort_max}"
     return True, "ok"
 
 VALIDATOR_FUNS = {
@@ -235,37 +439,88 @@ VALIDATOR_FUNS = {
     "comfort_band": v_comfort_band,  
 }
 
+# Each class's enforced chain is compiled into one function with its guard
+# constants inlined; validators without a template call into VALIDATOR_FUNS.
+def compile_class_validator(local: str, vtypes: Tuple[str,...]) -> ClassValidator:
+    gp = guard_for(local)
+    fname = "_validate_" + re.sub(r"\W", "_", local)
+    lines = [f"def {fname}(label, value, prev):"]
+    for v in vtypes:
+        if v == "range":
+            if gp.min is not None and gp.max is not None:
+                lines.append(f"    if value < {gp.min!r} or value > {gp.max!r}: return False, {f'range {gp.min}–{gp.max}'!r}")
+        elif v == "rate":
+            if gp.max_step is not None:
+                lines.append(f"    if prev is not None and abs(value - prev) > {gp.max_step!r}: return False, {f'step>{gp.max_step}'!r}")
+        elif v == "energy_budget":
+            lines.append(f"    if IS_COOL_SP.get(label, False) and value < {gp.min_cool_setpoint!r}"
+                         f" and int((20.0 - value) * {gp.energy_per_degree!r}) > {gp.energy_budget_watts!r}: return False, 'energy_budget'")
+        elif v == "comfort_band":
+            lines.append(f"    if value < {gp.comfort_min!r} or value > {gp.comfort_max!r}: return False, {f'comfort_band {gp.comfort_min}–{gp.comfort_max}'!r}")
+        else:
+            if v not in VALIDATOR_FUNS:
+                raise ValueError(f"Unknown validator type '{v}' for {local}")
+            lines.append(f"    ok, reason = FUNS[{v!r}]({local!r}, label, value, prev)")
+            lines.append("    if not ok: return False, reason")
+    lines.append("    return True, 'ok'")
+    ns = {"IS_COOL_SP": LABEL_IS_COOL_SP, "FUNS": VALIDATOR_FUNS}
+    exec(compile("\n".join(lines), f"<validator {local}>", "exec"), ns)
+    return ns[fname]
+
+# validator chains resolve VALIDATOR_FUNS, so policy is loaded once they exist
+load_all()
+
 # ---------------- Live monitor ----------------
 RISK = {"cooling_low_excess": False}
 MON_RUNNING = True
+# Cooling points below monitor.cooling_min are tracked on write: LOW_SINCE holds
+# when each label went low, LOW_TRACK the seconds of already-closed low spells in
+# the current window. The monitor sums both, i.e. point-seconds spent low.
+LOW_LOCK = threading.Lock()
+LOW_SINCE: Dict[str,float] = {}
+LOW_TRACK = {"window_start": time.time(), "closed": 0.0}
+
+def track_low(label: str, low: bool):
+    now = time.time()
+    with LOW_LOCK:
+        since = LOW_SINCE.get(label)
+        if low and since is None:
+            LOW_SINCE[label] = now
+        elif not low and since is not None:
+            del LOW_SINCE[label]
+            LOW_TRACK["closed"] += now - max(since, LOW_TRACK["window_start"])
+
+def take_low_seconds() -> float:
+    # point-seconds spent low since the last call; starts a new window
+    now = time.time()
+    with LOW_LOCK:
+        start = LOW_TRACK["window_start"]
+        total = LOW_TRACK["closed"] + sum(now - max(since, start) for since in LOW_SINCE.values())
+        LOW_TRACK["window_start"] = now; LOW_TRACK["closed"] = 0.0
+    return total
 
 def monitor_loop():
     while True:
         if not MON_RUNNING:
+            take_low_seconds()  # time spent low while stopped is not counted
             time.sleep(0.5); continue
         cfg = POLICY.get("monitor", {})
         window = cfg.get("window_seconds", 12)
         threshold = cfg.get("threshold_count", 5)
-        cmin = cfg.get("cooling_min", 20.0)
         reset = cfg.get("cooling_reset", 22.0)
-        cnt = 0; start = time.time()
-        while time.time() - start < window:
-            for k,v in STATE.items():
-                if "Cool_SP" in k and v < cmin:
-                    cnt += 1
-            time.sleep(1)
-        if cnt >= threshold:
+        time.sleep(window)
+        if take_low_seconds() >= threshold:
             RISK["cooling_low_excess"] = True
             for act in cfg.get("actions", []):
                 if act["type"] == "reset_points":
                     for k in list(STATE.keys()):
                         if act.get("match","") in k:
-                            STATE[k] = reset; log_timeseries(k, reset)
+                            proxy_write(k, reset)
                 elif act["type"] == "revoke_capabilities":
-                    for aid, inst in APPS.items():
+                    for aid, inst in apps_snapshot():
                         inst["caps"]["write"] = []
                 elif act["type"] == "terminate_apps":
-                    for aid in list(APPS.keys()):
+                    for aid, _ in apps_snapshot():
                         stop_app_instance(aid)
         else:
             RISK["cooling_low_excess"] = False
@@ -294,21 +549,23 @@ def start_app_instance(man: Manifest) -> Dict:
     p = subprocess.Popen(["python3", "apps/comfort_app.py"], env=env)
     inst = {"manifest": man.__dict__, "pid": p.pid, "key": APP_KEY, "caps": caps, "user": man.user,
             "rate": {"limit": man.write_rate_limit_per_min, "tokens": 0, "win": int(time.time()//60)}}
-    APPS[app_instance_id] = inst
-    APP_KEYS[APP_KEY] = app_instance_id
+    with APPS_LOCK:
+        _APPS[app_instance_id] = inst
+        _APP_KEYS[APP_KEY] = app_instance_id
     return {"app_instance_id": app_instance_id, "pid": p.pid, "key": APP_KEY}
 
 def stop_app_instance(aid: str):
-    inst = APPS.get(aid)
+    with APPS_LOCK:
+        inst = _APPS.pop(aid, None)
+        if inst:
+            _APP_KEYS.pop(inst["key"], None)
     if not inst: return
     try: os.kill(inst["pid"], signal.SIGTERM)
     except Exception: pass
-    APP_KEYS.pop(inst["key"], None)
-    APPS.pop(aid, None)
 
 def list_instances():
     out = []
-    for aid, inst in APPS.items():
+    for aid, inst in apps_snapshot():
         out.append({"id": aid, "pid": inst["pid"], "user": inst["user"],
                     "caps": {"read": [IRI2LABEL.get(i,i) for i in inst["caps"]["read"]],
                              "write":[IRI2LABEL.get(i,i) for i in inst["caps"]["write"]]}})
@@ -330,63 +587,92 @@ class WriteReq(BaseModel):
     prev_value: Optional[float] = None
 
 # ---------------- Auth ----------------
-APPS: Dict[str, Dict] = APPS
-APP_KEYS: Dict[str, str] = APP_KEYS
-
 def get_app_instance_from_key(app_key: Optional[str]) -> Tuple[str,dict]:
     if not app_key:
         raise HTTPException(status_code=401, detail="Missing X-App-Key")
     aid = APP_KEYS.get(app_key)
-    if not aid:
+    inst = APPS.get(aid) if aid else None
+    if not inst:  # unknown key, or the instance was stopped concurrently
         raise HTTPException(status_code=403, detail="Invalid X-App-Key")
-    return aid, APPS[aid]
+    return aid, inst
+
+async def app_auth(x_app_key: Optional[str] = Header(default=None)) -> Tuple[str,dict]:
+    return get_app_instance_from_key(x_app_key)
 
 # ---------------- Endpoints ----------------
+# Endpoints that only touch in-memory state are async and run on the event loop.
+# Ones that hit SQLite, SPARQL, spawn processes or take UPDATE_LOCK stay sync so
+# they run in the threadpool.
 @app.get("/health")
-def health():
+async def health():
     return {"status": "ok", "risk": RISK}
 
 @app.post("/admin/reload")
 def admin_reload():
     load_all()
-    for aid, inst in APPS.items():
+    for aid, inst in apps_snapshot():
         man = Manifest(**inst["manifest"])
         inst["caps"] = compute_caps(man)
     return {"ok": True}
 
 @app.post("/admin/monitor")
-def admin_monitor(enable: bool):
+async def admin_monitor(enable: bool):
     global MON_RUNNING
     MON_RUNNING = enable
     return {"ok": True, "monitor": "running" if enable else "stopped"}
 
+def stream_rows(cur: sqlite3.Cursor, batch: int = 1000):
+    # emits {"rows": [...]} one fetchmany batch at a time
+    yield '{"rows": ['
+    sep = ""
+    while rows := cur.fetchmany(batch):
+        yield sep + ",".join(json.dumps(dict(r)) for r in rows)
+        sep = ","
+    yield "]}"
+
 @app.get("/admin/txlog")
 def admin_txlog(limit: int = 50):
-    cur = DB.execute("SELECT ts,actor,app_id,user_id,action,point_label,value,decision,reason FROM txlog ORDER BY id DESC LIMIT ?", (limit,))
-    return {"rows": cur.fetchall()}
+    with read_conn() as conn:
+        cur = conn.execute("SELECT ts,actor,app_id,user_id,action,point_label,value,decision,reason FROM txlog ORDER BY id DESC LIMIT ?", (limit,))
+        return {"rows": [dict(r) for r in cur]}
 
 @app.get("/admin/shadow_log")
 def admin_shadow_log(limit: int = 50):
-    cur = DB.execute("SELECT ts,app_id,user_id,point_label,value,cls,vtype,reason FROM shadowlog ORDER BY id DESC LIMIT ?", (limit,))
-    return {"rows": cur.fetchall()}
+    with read_conn() as conn:
+        cur = conn.execute("SELECT ts,app_id,user_id,point_label,value,cls,vtype,reason FROM shadowlog ORDER BY id DESC LIMIT ?", (limit,))
+        return {"rows": [dict(r) for r in cur]}
 
 @app.get("/admin/shadow_stats")
 def admin_shadow_stats():
-    cur = DB.execute("SELECT point_label, vtype, reason, COUNT(*) FROM shadowlog GROUP BY point_label, vtype, reason ORDER BY COUNT(*) DESC")
-    return {"rows": cur.fetchall()}
+    # acquire before streaming starts so a busy pool can still answer 503;
+    # the connection is held until the response finishes streaming
+    conn = acquire_read_conn()
+    try:
+        cur = conn.execute("SELECT point_label, vtype, reason, COUNT(*) AS count FROM shadowlog GROUP BY point_label, vtype, reason ORDER BY count DESC")
+    except Exception:
+        release_read_conn(conn)
+        raise
+    def body():
+        try:
+            yield from stream_rows(cur)
+        finally:
+            release_read_conn(conn)
+    return StreamingResponse(body(), media_type="application/json")
 
 @app.post("/admin/promote_shadow")
 def admin_promote_shadow(resource_class: str):
     local = resource_class.split("#")[-1] if "#" in resource_class else resource_class
-    cur = DB.execute("SELECT vtype FROM shadow_validators WHERE resource_class=? ORDER BY position ASC", (local,))
-    sv = [r[0] for r in cur.fetchall()]
-    if not sv:
-        raise HTTPException(404, "No shadow validators to promote for class")
-    cur2 = DB.execute("SELECT MAX(position) FROM validators WHERE resource_class=?", (local,))
-    base = cur2.fetchone()[0] or -1
-    with DB:
-        for i, v in enumerate(sv):
-            DB.execute("INSERT INTO validators(resource_class,position,vtype) VALUES(?,?,?)", (local, base+1+i, v))
+    with UPDATE_LOCK:
+        cur = DB.execute("SELECT vtype FROM shadow_validators WHERE resource_class=? ORDER BY position ASC", (local,))
+        sv = [r[0] for r in cur.fetchall()]
+        if not sv:
+            raise HTTPException(404, "No shadow validators to promote for class")
+        cur2 = DB.execute("SELECT MAX(position) FROM validators WHERE resource_class=?", (local,))
+        base = cur2.fetchone()[0] or -1
+        with DB:
+            for i, v in enumerate(sv):
+                DB.execute("INSERT INTO validators(resource_class,position,vtype) VALUES(?,?,?)", (local, base+1+i, v))
+        refresh_db_caches()
     return {"ok": True, "promoted": sv, "class": local}
 
 @app.post("/admin/app/register")
@@ -401,18 +687,18 @@ def admin_stop(aid: str):
     return {"ok": True}
 
 @app.get("/admin/app/list")
-def admin_list():
+async def admin_list():
     return list_instances()
 
 @app.get("/capabilities")
-def capabilities(x_app_key: Optional[str] = Header(default=None)):
-    aid, inst = get_app_instance_from_key(x_app_key)
+async def capabilities(ctx: Tuple[str,dict] = Depends(app_auth)):
+    aid, inst = ctx
     pts = sorted(set(inst["caps"]["read"] + inst["caps"]["write"]))
     return {"app_instance": aid, "points": [{"iri": i, "label": IRI2LABEL.get(i,i)} for i in pts]}
 
 @app.get("/read")
-def read(point_label: str, x_app_key: Optional[str] = Header(default=None)):
-    aid, inst = get_app_instance_from_key(x_app_key)
+async def read(point_label: str, ctx: Tuple[str,dict] = Depends(app_auth)):
+    aid, inst = ctx
     iri = LABEL2IRI.get(point_label)
     if not iri:
         raise HTTPException(404, "Unknown point")
@@ -424,9 +710,9 @@ def read(point_label: str, x_app_key: Optional[str] = Header(default=None)):
     return {"point_label": point_label, "value": val}
 
 @app.post("/write")
-def write(req: WriteReq, x_app_key: Optional[str] = Header(default=None)):
+def write(req: WriteReq, ctx: Tuple[str,dict] = Depends(app_auth)):
     with UPDATE_LOCK:
-        aid, inst = get_app_instance_from_key(x_app_key)
+        aid, inst = ctx
         if not token_bucket_ok(inst):
             raise HTTPException(429, "Write rate limit exceeded")
         iri = LABEL2IRI.get(req.point_label)
@@ -436,19 +722,19 @@ def write(req: WriteReq, x_app_key: Optional[str] = Header(default=None)):
             log_tx("app", aid, inst["user"], "write", iri, req.point_label, req.value, "deny", "no-cap-write")
             raise HTTPException(403, "No write capability")
         cls = class_of_iri(iri) or ""
-        vlist = get_validators_for_class(cls)
-        if not vlist:
+        local = IRI2LOCALCLASS.get(iri, "")
+        check = _CLASS_VALIDATOR.get(local)
+        if check is None:
             log_tx("regulator", aid, inst["user"], "write", iri, req.point_label, req.value, "deny", "no-validators")
             raise HTTPException(400, "No validators configured")
         prev = proxy_read(req.point_label)
-        for vname in vlist:
-            ok, reason = VALIDATOR_FUNS[vname](cls, req.point_label, req.value, prev)
-            if not ok:
-                log_tx("regulator", aid, inst["user"], "write", iri, req.point_label, req.value, "deny", reason)
-                raise HTTPException(400, f"Guard blocked: {reason}")
-        sv = get_shadow_validators_for_class(cls)
-        for vname in sv:
-            ok, reason = VALIDATOR_FUNS[vname](cls, req.point_label, req.value, prev)
+        ok, reason = check(req.point_label, req.value, prev)
+        if not ok:
+            log_tx("regulator", aid, inst["user"], "write", iri, req.point_label, req.value, "deny", reason)
+            raise HTTPException(400, f"Guard blocked: {reason}")
+        sfns, snames = get_shadow_validators_for_class(local)
+        for fn, vname in zip(sfns, snames):
+            ok, reason = fn(local, req.point_label, req.value, prev)
             if not ok:
                 log_shadow(aid, inst["user"], iri, req.point_label, req.value, cls, vname, reason)
         proxy_write(req.point_label, req.value)